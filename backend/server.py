@@ -1,31 +1,453 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Response, WebSocket, WebSocketDisconnect
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 import os
+import sys
+import asyncio
+import hmac
 import logging
+import random
+import struct
+import threading
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import uuid
+import time
 from datetime import datetime
+from email.utils import formatdate
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Request profiling
+# Opt-in: a request is profiled when it carries X-Profile-Token matching
+# PROFILE_TOKEN, or when it is picked by PROFILE_SAMPLE_RATE (0.0 - 1.0).
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '2'))
+PROFILE_MAX_STORED = int(os.environ.get('PROFILE_MAX_STORED', '50'))
+PROFILE_HEADER = b"x-profile-token"
+
+# Frames that mark response serialization inside FastAPI/Starlette
+SERIALIZATION_FRAMES = {"serialize_response", "jsonable_encoder", "render"}
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class RequestProfile:
+    """Stack samples and Mongo timings collected for one request"""
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.status_code: Optional[int] = None
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.duration_ms = 0.0
+        self.task = asyncio.current_task()
+        self.thread_id = threading.get_ident()
+        self.root_frame = None
+        self.stacks: Dict[Tuple[str, ...], int] = {}
+        self.categories: Dict[str, int] = {}
+        self.mongo_in_flight = 0
+        self.mongo_commands = 0
+        self.mongo_ms = 0.0
+
+    def sample(self, thread_frame):
+        # finish() may clear these from the loop thread while we sample
+        root_frame, task = self.root_frame, self.task
+        if root_frame is None or task is None:
+            return
+        frames = []
+        frame = thread_frame
+        while frame is not None:
+            frames.append(frame)
+            if frame is root_frame:
+                break
+            frame = frame.f_back
+        running = frame is not None
+        if running:
+            frames.reverse()
+        else:
+            # Not on the loop thread right now: read where the task is suspended
+            frames = []
+            found = False
+            coro = task.get_coro()
+            while coro is not None:
+                frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+                if frame is None:
+                    break
+                if frame is root_frame:
+                    found = True
+                if found:
+                    frames.append(frame)
+                coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+            if not found:
+                return
+
+        labels = [_frame_label(f.f_code) for f in frames[1:]]
+        if running:
+            if any(f.f_code.co_name in SERIALIZATION_FRAMES for f in frames):
+                category = "serialization"
+            else:
+                category = "python"
+        else:
+            category = "await_mongo" if self.mongo_in_flight else "await_other"
+            labels.append("[await mongo]" if self.mongo_in_flight else "[await]")
+
+        key = tuple(labels)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.categories[category] = self.categories.get(category, 0) + 1
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "samples": sum(self.categories.values()),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "categories_ms": {k: round(v * PROFILE_INTERVAL_MS, 3) for k, v in self.categories.items()},
+            "mongo": {"commands": self.mongo_commands, "total_ms": round(self.mongo_ms, 3)},
+        }
+
+    def folded(self) -> str:
+        """Collapsed stacks, one "frame;frame;frame count" line each, for flamegraph.pl or speedscope"""
+        root = f"{self.method} {self.path}".replace(";", ",")
+        lines = []
+        for stack, count in sorted(self.stacks.items()):
+            lines.append(";".join((root,) + tuple(s.replace(";", ",") for s in stack)) + f" {count}")
+        return "".join(line + "\n" for line in lines)
+
+class RequestProfiler:
+    """Samples active request profiles from a background thread and keeps the latest results"""
+
+    def __init__(self, interval_ms: float, max_stored: int):
+        self.interval_s = interval_ms / 1000
+        self.active: Dict[str, RequestProfile] = {}
+        self.store: "OrderedDict[str, RequestProfile]" = OrderedDict()
+        self.max_stored = max_stored
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+    def trigger(self, scope) -> Optional[str]:
+        if PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    if hmac.compare_digest(value, PROFILE_TOKEN.encode()):
+                        return "header"
+                    break
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sampled"
+        return None
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self.active[profile.id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def finish(self, profile: RequestProfile):
+        profile.duration_ms = (time.perf_counter() - profile.started) * 1000
+        with self._lock:
+            self.active.pop(profile.id, None)
+            # The middleware frame holds the ASGI scope (headers, credentials)
+            # and the task; stored profiles only need their aggregates
+            profile.root_frame = None
+            profile.task = None
+            self.store[profile.id] = profile
+            while len(self.store) > self.max_stored:
+                self.store.popitem(last=False)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self.active.values())
+                if not profiles:
+                    self._wake.clear()
+            if not profiles:
+                self._wake.wait()
+                continue
+            frames = sys._current_frames()
+            for profile in profiles:
+                profile.sample(frames.get(profile.thread_id))
+            del frames
+            time.sleep(self.interval_s)
+
+profiler = RequestProfiler(PROFILE_INTERVAL_MS, PROFILE_MAX_STORED)
+
+class MongoProfileListener(monitoring.CommandListener):
+    """Charges Mongo command time to the profiled request that issued it"""
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.mongo_in_flight += 1
+
+    def succeeded(self, event):
+        self._done(event)
+
+    def failed(self, event):
+        self._done(event)
+
+    def _done(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.mongo_in_flight -= 1
+            profile.mongo_commands += 1
+            profile.mongo_ms += event.duration_micros / 1000
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles opted-in requests and passes everything else straight through"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+        # Browsing the profile store must not evict the captures being browsed
+        trigger = None if scope["path"].startswith("/api/debug/") else profiler.trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], trigger)
+        profile.root_frame = sys._getframe()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        token = current_profile.set(profile)
+        profiler.start(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.finish(profile)
+            current_profile.reset(token)
+
 # MongoDB connection
+# The client is created, warmed up and closed by the app lifespan below.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '10'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+MONGO_READY_TIMEOUT_MS = int(os.environ.get('MONGO_READY_TIMEOUT_MS', '800'))
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Tracks open and checked-out connections for each server's pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open: Dict[Tuple[str, int], int] = {}
+        self.in_use: Dict[Tuple[str, int], int] = {}
+        self.checkout_failures = 0
+
+    def _add(self, counts: Dict[Tuple[str, int], int], address, delta: int):
+        with self._lock:
+            counts[address] = counts.get(address, 0) + delta
+
+    def connection_created(self, event):
+        self._add(self.open, event.address, 1)
+
+    def connection_closed(self, event):
+        self._add(self.open, event.address, -1)
+
+    def connection_checked_out(self, event):
+        self._add(self.in_use, event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self.in_use, event.address, -1)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.open.pop(event.address, None)
+            self.in_use.pop(event.address, None)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = {
+                f"{host}:{port}": {"open": self.open.get((host, port), 0), "in_use": self.in_use.get((host, port), 0)}
+                for host, port in set(self.open) | set(self.in_use)
+            }
+            checkout_failures = self.checkout_failures
+        # maxPoolSize applies per server, so report the busiest pool
+        busiest = max((pool["in_use"] for pool in pools.values()), default=0)
+        return {
+            "max_size": MONGO_MAX_POOL_SIZE,
+            "min_size": MONGO_MIN_POOL_SIZE,
+            "open": sum(pool["open"] for pool in pools.values()),
+            "in_use": sum(pool["in_use"] for pool in pools.values()),
+            "saturation": round(busiest / MONGO_MAX_POOL_SIZE, 3) if MONGO_MAX_POOL_SIZE else 0.0,
+            "checkout_failures": checkout_failures,
+            "pools": pools,
+        }
+
+pool_monitor = PoolMonitor()
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+async def warm_up_database():
+    """Select a server, pre-open the minimum pool and make sure query indexes exist"""
+    await db.command("ping")
+    # Concurrent round trips force the pool to open that many connections now
+    # instead of on the first requests after a deploy
+    await asyncio.gather(*(db.command("ping") for _ in range(MONGO_MIN_POOL_SIZE)))
+    await asyncio.gather(
+        db.messages.create_index([("room_id", 1), ("timestamp", -1)]),
+        db.users.create_index("device_id"),
+        db.users.create_index("is_online"),
+        db.mesh_nodes.create_index("device_id"),
+        db.mesh_nodes.create_index("is_active"),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db
+    event_listeners = [pool_monitor]
+    if profiler.enabled:
+        # Command events are built for every command once a listener exists,
+        # so only pay for them when profiling is configured
+        event_listeners.append(MongoProfileListener())
+    client = AsyncIOMotorClient(
+        mongo_url,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=event_listeners,
+    )
+    db = client[os.environ['DB_NAME']]
+    started = time.perf_counter()
+    try:
+        await warm_up_database()
+        logger.info("Database warm-up finished in %.1f ms", (time.perf_counter() - started) * 1000)
+    except Exception as e:
+        # Keep serving; /api/ready reports the database as unavailable until it recovers
+        logger.error("Database warm-up failed: %s", e)
+    try:
+        yield
+    finally:
+        client.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 
+# Version stamps for conditional GETs
+# Version counters live in one process, so a worker cannot see writes handled
+# by its siblings. WEB_CONCURRENCY (read by uvicorn and gunicorn for their
+# worker count) above 1 turns off 304 answers; set it when running --workers.
+CONDITIONAL_GET_ENABLED = int(os.environ.get('WEB_CONCURRENCY', '1')) <= 1
+
+class VersionStamps:
+    """In-process version counters for list endpoints, bumped on every write.
+
+    ETags carry a per-process boot id so a restart never answers 304 to a
+    client holding a tag minted by a previous process. The 304 path assumes
+    a single worker process: with several, a worker that did not handle a
+    write would keep validating its stale tag.
+    """
+
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.started_at = time.time()
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, float] = {}
+
+    def bump(self, key: str):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._modified[key] = time.time()
+
+    def etag(self, key: str, *variant) -> str:
+        parts = [self.boot_id, str(self._versions.get(key, 0))]
+        parts.extend(str(v) for v in variant)
+        return 'W/"%s"' % "-".join(parts)
+
+    def last_modified(self, key: str) -> str:
+        return formatdate(self._modified.get(key, self.started_at), usegmt=True)
+
+versions = VersionStamps()
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def conditional_get(response: Response, if_none_match: Optional[str], key: str, *variant) -> Optional[Response]:
+    """Stamp validators on the response, or return a 304 if the client is current"""
+    headers = {
+        "ETag": versions.etag(key, *variant),
+        "Last-Modified": versions.last_modified(key),
+        "Cache-Control": "no-cache",
+    }
+    if CONDITIONAL_GET_ENABLED and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
 # Define Models for Gobchat
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -81,6 +503,7 @@ async def send_message(message_data: MessageCreate):
         
         # Save to database
         await db.messages.insert_one(message_obj.dict())
+        versions.bump(f"messages:{message_obj.room_id}")
         
         # Here we would broadcast to mesh network peers
         # For now, just return the message
@@ -89,8 +512,16 @@ async def send_message(message_data: MessageCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/messages", response_model=List[Message])
-async def get_messages(room_id: str = "global", limit: int = 50):
+async def get_messages(
+    response: Response,
+    room_id: str = "global",
+    limit: int = 50,
+    if_none_match: Optional[str] = Header(None),
+):
     """Get messages from a room"""
+    not_modified = conditional_get(response, if_none_match, f"messages:{room_id}", limit)
+    if not_modified:
+        return not_modified
     try:
         messages = await db.messages.find(
             {"room_id": room_id}
@@ -107,6 +538,7 @@ async def clear_messages(room_id: str = "global"):
     """Clear all messages from a room"""
     try:
         result = await db.messages.delete_many({"room_id": room_id})
+        versions.bump(f"messages:{room_id}")
         return {"deleted_count": result.deleted_count}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -124,19 +556,24 @@ async def register_user(user_data: UserCreate):
                 {"device_id": user_data.device_id},
                 {"$set": {"last_seen": datetime.utcnow(), "is_online": True}}
             )
+            versions.bump("users")
             return User(**existing_user)
         
         user_dict = user_data.dict()
         user_obj = User(**user_dict)
         
         await db.users.insert_one(user_obj.dict())
+        versions.bump("users")
         return user_obj
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/users", response_model=List[User])
-async def get_online_users():
+async def get_online_users(response: Response, if_none_match: Optional[str] = Header(None)):
     """Get list of online users"""
+    not_modified = conditional_get(response, if_none_match, "users")
+    if not_modified:
+        return not_modified
     try:
         users = await db.users.find({"is_online": True}).to_list(100)
         return [User(**user) for user in users]
@@ -153,6 +590,7 @@ async def update_user_status(device_id: str, is_online: bool):
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
+        versions.bump("users")
         return {"status": "updated"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -170,19 +608,24 @@ async def register_mesh_node(node_data: MeshNodeCreate):
                 {"device_id": node_data.device_id},
                 {"$set": {"last_ping": datetime.utcnow(), "is_active": True}}
             )
+            versions.bump("mesh_nodes")
             return MeshNode(**existing_node)
         
         node_dict = node_data.dict()
         node_obj = MeshNode(**node_dict)
         
         await db.mesh_nodes.insert_one(node_obj.dict())
+        versions.bump("mesh_nodes")
         return node_obj
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/mesh/nodes", response_model=List[MeshNode])
-async def get_mesh_nodes():
+async def get_mesh_nodes(response: Response, if_none_match: Optional[str] = Header(None)):
     """Get active mesh nodes"""
+    not_modified = conditional_get(response, if_none_match, "mesh_nodes")
+    if not_modified:
+        return not_modified
     try:
         nodes = await db.mesh_nodes.find({"is_active": True}).to_list(100)
         return [MeshNode(**node) for node in nodes]
@@ -199,6 +642,7 @@ async def ping_mesh_node(device_id: str):
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Node not found")
+        versions.bump("mesh_nodes")
         return {"status": "pinged"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -213,25 +657,348 @@ async def disconnect_mesh_node(device_id: str):
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Node not found")
+        versions.bump("mesh_nodes")
         return {"status": "disconnected"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Voice relay
+# Frames are relayed in memory only; nothing here touches the database.
+VOICE_FRAME_MS = int(os.environ.get('VOICE_FRAME_MS', '20'))
+VOICE_TARGET_DELAY_MS = int(os.environ.get('VOICE_TARGET_DELAY_MS', '60'))
+VOICE_MAX_BUFFER_FRAMES = int(os.environ.get('VOICE_MAX_BUFFER_FRAMES', '25'))
+VOICE_MAX_FRAME_BYTES = int(os.environ.get('VOICE_MAX_FRAME_BYTES', '4096'))
+# Inbound binary frame: seq (uint32), sender timestamp in ms (uint64), payload.
+# Senders start at seq 0 on each connection; wraparound is not handled, which
+# at 20 ms frames takes over two years of continuous talk on one connection.
+VOICE_IN_HEADER = struct.Struct("!IQ")
+# Outbound binary frame: stream id (uint16), seq (uint32), sender timestamp in ms (uint64), payload
+VOICE_OUT_HEADER = struct.Struct("!HIQ")
+
+class VoiceStreamStats(BaseModel):
+    received: int = 0
+    forwarded: int = 0
+    lost: int = 0  # gaps skipped at playout time
+    late: int = 0  # arrived after their playout slot
+    duplicates: int = 0
+    overflow: int = 0  # dropped because the buffer was full
+    malformed: int = 0
+    jitter_ms: float = 0.0  # RFC 3550 interarrival jitter
+    buffer_delay_ms: float = 0.0  # smoothed time spent in the relay
+
+class JitterBuffer:
+    """Reorders one speaker's frames and releases them at a steady frame rate.
+
+    Playout starts VOICE_TARGET_DELAY_MS after the first frame of a talk spurt
+    and then advances one sequence number per frame interval. A frame missing
+    at its deadline is counted as lost and skipped; when the buffer runs dry
+    the spurt is over and the next frame starts a new one.
+    """
+
+    def __init__(self, frame_ms: int, target_delay_ms: int, max_frames: int):
+        self.frame_s = frame_ms / 1000
+        self.target_delay_s = target_delay_ms / 1000
+        self.max_frames = max_frames
+        self.frames: Dict[int, Tuple[int, bytes, float]] = {}
+        self.next_seq: Optional[int] = None
+        self.next_due = 0.0
+        self.playing = False
+        self.stats = VoiceStreamStats()
+        self._last_transit: Optional[float] = None
+
+    def push(self, seq: int, sent_at_ms: int, payload: bytes, now: float):
+        stats = self.stats
+        stats.received += 1
+
+        transit = now * 1000 - sent_at_ms
+        if self._last_transit is not None:
+            stats.jitter_ms += (abs(transit - self._last_transit) - stats.jitter_ms) / 16
+        self._last_transit = transit
+
+        if self.next_seq is not None and seq < self.next_seq:
+            if self.playing:
+                stats.late += 1
+                return
+            # Still prebuffering, so an earlier frame can move the start back
+            self.next_seq = seq
+        if seq in self.frames:
+            stats.duplicates += 1
+            return
+        if len(self.frames) >= self.max_frames:
+            oldest = min(self.frames)
+            del self.frames[oldest]
+            stats.overflow += 1
+            if self.next_seq is not None and self.next_seq <= oldest:
+                self.next_seq = oldest + 1
+
+        self.frames[seq] = (sent_at_ms, payload, now)
+        if self.next_seq is None:
+            self.next_seq = seq
+            self.next_due = now + self.target_delay_s
+
+    def pop_due(self, now: float) -> List[Tuple[int, int, bytes]]:
+        """Return (seq, sent_at_ms, payload) for every frame whose slot has passed"""
+        out = []
+        stats = self.stats
+        while self.next_seq is not None and now >= self.next_due:
+            frame = self.frames.pop(self.next_seq, None)
+            if frame is None:
+                if not self.frames:
+                    self.next_seq = None
+                    self.playing = False
+                    break
+                oldest = min(self.frames)
+                if oldest - self.next_seq > self.max_frames:
+                    # The sender jumped ahead (e.g. skipped seqs across silence);
+                    # resync instead of charging the whole gap as loss
+                    self.next_seq = oldest
+                    continue
+                stats.lost += 1
+            else:
+                sent_at_ms, payload, arrived = frame
+                stats.forwarded += 1
+                stats.buffer_delay_ms += ((now - arrived) * 1000 - stats.buffer_delay_ms) / 16
+                out.append((self.next_seq, sent_at_ms, payload))
+            self.playing = True
+            self.next_seq += 1
+            self.next_due += self.frame_s
+        return out
+
+    def next_deadline(self) -> Optional[float]:
+        return self.next_due if self.next_seq is not None else None
+
+class VoiceListener:
+    """A room member's outbound queue, drained by its own writer task"""
+
+    def __init__(self, websocket: WebSocket, device_id: str, username: str):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.username = username
+        # One FIFO keeps announcements ahead of their stream's frames; only audio
+        # counts against the bound, so control messages are never dropped
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.queued_frames = 0
+        self.dropped = 0
+        self.stream_id: Optional[int] = None
+        self.buffer: Optional[JitterBuffer] = None
+
+    def offer(self, data):
+        if isinstance(data, bytes):
+            # A slow listener loses frames instead of stalling the whole room
+            if self.queued_frames >= VOICE_MAX_BUFFER_FRAMES:
+                self.dropped += 1
+                return
+            self.queued_frames += 1
+        self.queue.put_nowait(data)
+
+    async def run(self):
+        try:
+            while True:
+                data = await self.queue.get()
+                if isinstance(data, bytes):
+                    self.queued_frames -= 1
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_json(data)
+        except Exception as e:
+            # The socket is gone; the receive loop sees the disconnect and cleans up
+            logger.debug("Voice listener %s stopped: %s", self.device_id, e)
+
+class VoiceRoom:
+    """Listeners and speaker streams for one room, paced by a single playout task"""
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.listeners: Dict[str, VoiceListener] = {}
+        self._next_stream_id = 1
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def join(self, connection_id: str, listener: VoiceListener):
+        self.listeners[connection_id] = listener
+        for other in self.listeners.values():
+            if other.stream_id is not None and other is not listener:
+                listener.offer(self._announcement(other))
+        if self._task is None:
+            self._task = asyncio.create_task(self._playout())
+
+    def leave(self, connection_id: str):
+        listener = self.listeners.pop(connection_id, None)
+        if listener is not None and listener.stream_id is not None:
+            self._broadcast({"type": "stream_end", "stream_id": listener.stream_id})
+        if not self.listeners and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def receive(self, listener: VoiceListener, data: bytes):
+        if listener.buffer is None:
+            listener.buffer = JitterBuffer(VOICE_FRAME_MS, VOICE_TARGET_DELAY_MS, VOICE_MAX_BUFFER_FRAMES)
+            listener.stream_id = self._next_stream_id
+            self._next_stream_id = self._next_stream_id % 0xFFFF + 1
+            self._broadcast(self._announcement(listener), skip=listener)
+        if len(data) < VOICE_IN_HEADER.size or len(data) > VOICE_MAX_FRAME_BYTES:
+            listener.buffer.stats.malformed += 1
+            return
+        seq, sent_at_ms = VOICE_IN_HEADER.unpack_from(data)
+        listener.buffer.push(seq, sent_at_ms, data[VOICE_IN_HEADER.size:], time.monotonic())
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        streams = []
+        for listener in self.listeners.values():
+            if listener.buffer is None:
+                continue
+            stats = listener.buffer.stats
+            expected = stats.forwarded + stats.lost
+            streams.append({
+                "stream_id": listener.stream_id,
+                "device_id": listener.device_id,
+                "username": listener.username,
+                "buffered_frames": len(listener.buffer.frames),
+                "loss_rate": stats.lost / expected if expected else 0.0,
+                **stats.dict(),
+            })
+        return {
+            "room_id": self.room_id,
+            "listeners": len(self.listeners),
+            "listener_drops": sum(listener.dropped for listener in self.listeners.values()),
+            "frame_ms": VOICE_FRAME_MS,
+            "target_delay_ms": VOICE_TARGET_DELAY_MS,
+            "streams": streams,
+        }
+
+    def _announcement(self, listener: VoiceListener) -> dict:
+        return {
+            "type": "stream",
+            "stream_id": listener.stream_id,
+            "device_id": listener.device_id,
+            "username": listener.username,
+        }
+
+    def _broadcast(self, data, skip: Optional[VoiceListener] = None):
+        for listener in self.listeners.values():
+            if listener is not skip:
+                listener.offer(data)
+
+    async def _playout(self):
+        while True:
+            now = time.monotonic()
+            deadline = None
+            for speaker in list(self.listeners.values()):
+                if speaker.buffer is None:
+                    continue
+                for seq, sent_at_ms, payload in speaker.buffer.pop_due(now):
+                    frame = VOICE_OUT_HEADER.pack(speaker.stream_id, seq, sent_at_ms) + payload
+                    self._broadcast(frame, skip=speaker)
+                due = speaker.buffer.next_deadline()
+                if due is not None and (deadline is None or due < deadline):
+                    deadline = due
+
+            self._wakeup.clear()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+voice_rooms: Dict[str, VoiceRoom] = {}
+
+@api_router.websocket("/voice/{room_id}")
+async def voice_relay(websocket: WebSocket, room_id: str, device_id: str, username: str = ""):
+    """Relay live voice frames between the members of a room"""
+    await websocket.accept()
+    room = voice_rooms.get(room_id)
+    if room is None:
+        room = voice_rooms[room_id] = VoiceRoom(room_id)
+
+    connection_id = str(uuid.uuid4())
+    listener = VoiceListener(websocket, device_id, username)
+    room.join(connection_id, listener)
+    writer = asyncio.create_task(listener.run())
+    try:
+        while not writer.done():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                room.receive(listener, message["bytes"])
+    except WebSocketDisconnect:
+        pass
+    finally:
+        writer.cancel()
+        room.leave(connection_id)
+        if not room.listeners and voice_rooms.get(room_id) is room:
+            del voice_rooms[room_id]
+
+@api_router.get("/voice/{room_id}/stats")
+async def get_voice_stats(room_id: str):
+    """Get jitter, latency and loss stats for a room's live voice streams"""
+    room = voice_rooms.get(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="No active voice session")
+    return room.stats()
+
 # Health check endpoint
 @api_router.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "gobchat-api"}
 
+@api_router.get("/ready")
+async def readiness_check():
+    """Readiness check: database round trip and connection pool usage"""
+    started = time.perf_counter()
+    try:
+        # Answer within typical probe timeouts instead of waiting out server selection
+        await asyncio.wait_for(db.command("ping"), MONGO_READY_TIMEOUT_MS / 1000)
+    except Exception as e:
+        logger.warning("Readiness check failed: %r", e)
+        return JSONResponse(
+            status_code=503,
+            content={"status": "unavailable", "detail": "Database unreachable", "pool": pool_monitor.stats()},
+        )
+    return {
+        "status": "ready",
+        "db_latency_ms": round((time.perf_counter() - started) * 1000, 3),
+        "pool": pool_monitor.stats(),
+    }
+
+# Profiling endpoints
+def _require_profile_token(token: Optional[str]):
+    # Header values arrive latin-1 decoded; compare bytes so non-ASCII input is just a mismatch
+    if not PROFILE_TOKEN or not token or not hmac.compare_digest(token.encode("latin-1"), PROFILE_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Profiling access denied")
+
+@api_router.get("/debug/profiles")
+async def list_profiles(x_profile_token: Optional[str] = Header(None)):
+    """List captured request profiles, newest first"""
+    _require_profile_token(x_profile_token)
+    return [profile.summary() for profile in reversed(list(profiler.store.values()))]
+
+@api_router.get("/debug/profiles/{profile_id}")
+async def download_profile(profile_id: str, x_profile_token: Optional[str] = Header(None)):
+    """Download a captured profile as collapsed stacks for flame-graph tools"""
+    _require_profile_token(x_profile_token)
+    profile = profiler.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile.folded(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(ProfilingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified"],
 )
 
 # Configure logging
@@ -240,7 +1007,3 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
@@ -6,13 +6,21 @@ Tests all endpoints with realistic data for a mesh chat application
 
 import requests
 import json
+import os
+import struct
+import sys
 import uuid
 from datetime import datetime
+from pathlib import Path
 import time
+from websockets.sync.client import connect
 
 # Configuration
 BASE_URL = "https://nearby-gobchat.preview.emergentagent.com/api"
+WS_URL = BASE_URL.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
 TIMEOUT = 30
+# Must match the server's PROFILE_TOKEN to check profile capture and download
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
 
 class GobchatAPITester:
     def __init__(self):
@@ -106,6 +114,29 @@ class GobchatAPITester:
         
         return False
 
+    def test_readiness_check(self):
+        """Test readiness endpoint reports database latency and pool usage"""
+        try:
+            response = self.session.get(f"{self.base_url}/ready", timeout=TIMEOUT)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if (data.get("status") == "ready" and 
+                    isinstance(data.get("db_latency_ms"), (int, float)) and
+                    "saturation" in data.get("pool", {})):
+                    self.log_test("Readiness Check", True, 
+                                f"DB round trip {data['db_latency_ms']} ms", data)
+                    return True
+                else:
+                    self.log_test("Readiness Check", False, f"Unexpected response format: {data}")
+            else:
+                self.log_test("Readiness Check", False, f"HTTP {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Readiness Check", False, f"Request failed: {str(e)}")
+        
+        return False
+
     def test_user_registration(self):
         """Test user registration endpoint"""
         success_count = 0
@@ -281,6 +312,80 @@ class GobchatAPITester:
         
         return False
 
+    def check_revalidation(self, test_name, path, write):
+        """GET path, expect 304 for its ETag, run write(), expect a fresh 200"""
+        try:
+            response = self.session.get(f"{self.base_url}{path}", timeout=TIMEOUT)
+            etag = response.headers.get("ETag")
+            if response.status_code != 200 or not etag:
+                self.log_test(test_name, False, 
+                            f"Missing ETag: HTTP {response.status_code}")
+                return False
+            
+            response2 = self.session.get(
+                f"{self.base_url}{path}",
+                headers={"If-None-Match": etag},
+                timeout=TIMEOUT
+            )
+            if response2.status_code != 304:
+                self.log_test(test_name, False, 
+                            f"Expected 304 while unchanged, got HTTP {response2.status_code}")
+                return False
+            
+            # The write must invalidate the list's ETag
+            write_response = write()
+            if write_response.status_code != 200:
+                self.log_test(test_name, False, 
+                            f"Write failed: HTTP {write_response.status_code}: {write_response.text}")
+                return False
+            response3 = self.session.get(
+                f"{self.base_url}{path}",
+                headers={"If-None-Match": etag},
+                timeout=TIMEOUT
+            )
+            if response3.status_code == 200 and response3.headers.get("ETag") != etag:
+                self.log_test(test_name, True, 
+                            f"304 while idle, fresh ETag {response3.headers.get('ETag')} after write")
+                return True
+            self.log_test(test_name, False, 
+                        f"ETag not bumped after write: HTTP {response3.status_code}")
+                
+        except Exception as e:
+            self.log_test(test_name, False, f"Request failed: {str(e)}")
+        
+        return False
+
+    def test_conditional_get_messages(self):
+        """Test ETag revalidation on the message list, for new messages and room clears"""
+        message_data = dict(self.test_messages[0], text="Revalidation check")
+        sent = self.check_revalidation(
+            "Conditional GET Messages",
+            "/messages",
+            lambda: self.session.post(f"{self.base_url}/messages", json=message_data, timeout=TIMEOUT)
+        )
+        
+        # Use a throwaway room so the global room's messages stay for later tests
+        room_id = f"etag_{uuid.uuid4().hex[:8]}"
+        cleared = self.check_revalidation(
+            "Conditional GET Cleared Room",
+            f"/messages?room_id={room_id}",
+            lambda: self.session.delete(f"{self.base_url}/messages", params={"room_id": room_id}, timeout=TIMEOUT)
+        )
+        return sent and cleared
+
+    def test_conditional_get_users(self):
+        """Test ETag revalidation on the online user list"""
+        device_id = self.test_users[0]["device_id"]
+        return self.check_revalidation(
+            "Conditional GET Users",
+            "/users",
+            lambda: self.session.put(
+                f"{self.base_url}/users/{device_id}/status",
+                params={"is_online": True},
+                timeout=TIMEOUT
+            )
+        )
+
     def test_mesh_node_registration(self):
         """Test mesh node registration"""
         success_count = 0
@@ -350,6 +455,15 @@ class GobchatAPITester:
         
         return False
 
+    def test_conditional_get_mesh_nodes(self):
+        """Test ETag revalidation on the active mesh node list"""
+        device_id = self.test_nodes[0]["device_id"]
+        return self.check_revalidation(
+            "Conditional GET Mesh Nodes",
+            "/mesh/nodes",
+            lambda: self.session.put(f"{self.base_url}/mesh/nodes/{device_id}/ping", timeout=TIMEOUT)
+        )
+
     def test_mesh_node_ping(self):
         """Test pinging mesh nodes"""
         success_count = 0
@@ -410,6 +524,147 @@ class GobchatAPITester:
         
         return success_count == len(self.test_nodes)
 
+    def test_jitter_buffer(self):
+        """Test voice jitter buffer reordering, loss, late and overflow handling"""
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            from server import JitterBuffer
+            
+            frame_s = 0.02
+            buffer = JitterBuffer(frame_ms=20, target_delay_ms=60, max_frames=5)
+            # Seq 2 arrives before 1, seq 4 never arrives
+            for seq in [0, 2, 1, 3, 5]:
+                buffer.push(seq, seq * 20, b"audio", 0.0)
+            played = []
+            for tick in range(10):
+                if tick == 5:
+                    buffer.push(4, 80, b"audio", 0.15)  # after its slot was skipped
+                played += [seq for seq, _, _ in buffer.pop_due(0.06 + tick * frame_s)]
+            
+            checks = {
+                "reordered": played == [0, 1, 2, 3, 5],
+                "lost": buffer.stats.lost == 1,
+                "late": buffer.stats.late == 1,
+            }
+            
+            overflow = JitterBuffer(frame_ms=20, target_delay_ms=60, max_frames=3)
+            for seq in range(5):
+                overflow.push(seq, seq * 20, b"audio", 0.0)
+            checks["overflow"] = overflow.stats.overflow == 2 and sorted(overflow.frames) == [2, 3, 4]
+            
+            # A forward jump larger than the buffer resyncs instead of counting loss
+            jump = JitterBuffer(frame_ms=20, target_delay_ms=60, max_frames=5)
+            for seq in [0, 1, 2000, 2001]:
+                jump.push(seq, seq * 20, b"audio", 0.0)
+            jumped = []
+            for tick in range(6):
+                jumped += [seq for seq, _, _ in jump.pop_due(0.06 + tick * frame_s)]
+            checks["resync"] = jumped == [0, 1, 2000, 2001] and jump.stats.lost == 0
+            
+            failed = [name for name, ok in checks.items() if not ok]
+            if not failed:
+                self.log_test("Jitter Buffer", True, "Reorder, loss, late, overflow and resync behave as expected")
+                return True
+            self.log_test("Jitter Buffer", False, f"Failed checks: {failed}")
+            
+        except Exception as e:
+            self.log_test("Jitter Buffer", False, f"Check failed: {str(e)}")
+        
+        return False
+
+    def test_voice_relay(self):
+        """Test voice relay join, stream announcement, frame forwarding and stats"""
+        room_id = f"voice_{uuid.uuid4().hex[:8]}"
+        listener_user = self.test_users[1]
+        speaker_user = self.test_users[0]
+        try:
+            with connect(f"{WS_URL}/voice/{room_id}?device_id={listener_user['device_id']}"
+                         f"&username={listener_user['username']}", open_timeout=TIMEOUT) as listener, \
+                 connect(f"{WS_URL}/voice/{room_id}?device_id={speaker_user['device_id']}"
+                         f"&username={speaker_user['username']}", open_timeout=TIMEOUT) as speaker:
+                now_ms = int(time.time() * 1000)
+                for seq in range(3):
+                    speaker.send(struct.pack("!IQ", seq, now_ms + seq * 20) + b"\x00" * 40)
+                
+                announcement = json.loads(listener.recv(timeout=5))
+                if (announcement.get("type") != "stream" or 
+                    announcement.get("device_id") != speaker_user["device_id"]):
+                    self.log_test("Voice Relay", False, f"Unexpected announcement: {announcement}")
+                    return False
+                
+                frame = listener.recv(timeout=5)
+                stream_id, seq, sent_at_ms = struct.unpack_from("!HIQ", frame)
+                if stream_id != announcement["stream_id"] or seq != 0 or sent_at_ms != now_ms:
+                    self.log_test("Voice Relay", False, 
+                                f"Unexpected frame header: stream {stream_id}, seq {seq}")
+                    return False
+                
+                response = self.session.get(f"{self.base_url}/voice/{room_id}/stats", timeout=TIMEOUT)
+                if response.status_code == 200:
+                    data = response.json()
+                    streams = data.get("streams", [])
+                    if (data.get("listeners") == 2 and len(streams) == 1 and 
+                        streams[0].get("received") == 3):
+                        self.log_test("Voice Relay", True, 
+                                    f"Frame relayed, stream stats: {streams[0]}", data)
+                        return True
+                    self.log_test("Voice Relay", False, f"Unexpected stats: {data}")
+                else:
+                    self.log_test("Voice Relay", False, 
+                                f"HTTP {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Voice Relay", False, f"Request failed: {str(e)}")
+        
+        return False
+
+    def test_profiling_access(self):
+        """Test profile store auth, capture via token header, list and download"""
+        try:
+            response = self.session.get(f"{self.base_url}/debug/profiles", timeout=TIMEOUT)
+            if response.status_code != 403:
+                self.log_test("Profiling Access", False, 
+                            f"Expected 403 without token, got HTTP {response.status_code}")
+                return False
+            
+            if not PROFILE_TOKEN:
+                self.log_test("Profiling Access", True, 
+                            "403 without token; set PROFILE_TOKEN to check capture and download")
+                return True
+            
+            headers = {"X-Profile-Token": PROFILE_TOKEN}
+            self.session.get(f"{self.base_url}/messages", headers=headers, timeout=TIMEOUT)
+            response = self.session.get(f"{self.base_url}/debug/profiles", headers=headers, timeout=TIMEOUT)
+            if response.status_code != 200:
+                self.log_test("Profiling Access", False, 
+                            f"List failed: HTTP {response.status_code}: {response.text}")
+                return False
+            
+            # The newest entry is the messages request, not the listing itself
+            profiles = response.json()
+            if not profiles or profiles[0].get("path") != "/api/messages":
+                self.log_test("Profiling Access", False, f"Messages request not captured: {profiles[:1]}")
+                return False
+            
+            response = self.session.get(
+                f"{self.base_url}/debug/profiles/{profiles[0]['id']}",
+                headers=headers,
+                timeout=TIMEOUT
+            )
+            if (response.status_code == 200 and 
+                "attachment" in response.headers.get("Content-Disposition", "") and
+                all(line.startswith("GET /api/messages") for line in response.text.splitlines())):
+                self.log_test("Profiling Access", True, 
+                            f"Captured {profiles[0]['samples']} samples, downloaded collapsed stacks")
+                return True
+            self.log_test("Profiling Access", False, 
+                        f"Download failed: HTTP {response.status_code}: {response.text[:200]}")
+                
+        except Exception as e:
+            self.log_test("Profiling Access", False, f"Request failed: {str(e)}")
+        
+        return False
+
     def test_clear_messages(self):
         """Test clearing messages"""
         try:
@@ -441,15 +696,22 @@ class GobchatAPITester:
         # Test sequence
         tests = [
             ("Health Check", self.test_health_check),
+            ("Readiness Check", self.test_readiness_check),
             ("User Registration", self.test_user_registration),
             ("Get Online Users", self.test_get_online_users),
             ("User Status Update", self.test_user_status_update),
+            ("Conditional GET Users", self.test_conditional_get_users),
             ("Send Messages", self.test_send_messages),
             ("Get Messages", self.test_get_messages),
+            ("Conditional GET Messages", self.test_conditional_get_messages),
             ("Mesh Node Registration", self.test_mesh_node_registration),
             ("Get Mesh Nodes", self.test_get_mesh_nodes),
+            ("Conditional GET Mesh Nodes", self.test_conditional_get_mesh_nodes),
             ("Mesh Node Ping", self.test_mesh_node_ping),
             ("Mesh Node Disconnect", self.test_mesh_node_disconnect),
+            ("Jitter Buffer", self.test_jitter_buffer),
+            ("Voice Relay", self.test_voice_relay),
+            ("Profiling Access", self.test_profiling_access),
             ("Clear Messages", self.test_clear_messages)
         ]
         